@@ -2,6 +2,7 @@ import math
 from typing import Optional
 
 import torch
+import torch.nn.functional as F
 
 import triton
 import triton.language as tl
@@ -53,6 +54,8 @@ def _attention_core(Q, K, V, mask, bias, sm_scale, Out, stride_qz, stride_qh, st
     # load q: it will stay in SRAM throughout
     q_load_mask = offs_m[:, None] < N_CTX
     q = tl.load(q_ptrs, mask=q_load_mask, other=0.0)
+    # scale q once instead of every qk tile in the loop
+    q = (q * sm_scale).to(Q.dtype.element_ty)
     # loop over k, v and update accumulator
     for start_n in range(0, N_CTX, BLOCK_N):
         start_n = tl.multiple_of(start_n, BLOCK_N)
@@ -62,7 +65,6 @@ def _attention_core(Q, K, V, mask, bias, sm_scale, Out, stride_qz, stride_qh, st
         k = tl.load(k_ptrs + start_n * stride_kn, mask=load_mask, other=0.0)
         qk = tl.zeros([BLOCK_M, BLOCK_N], dtype=tl.float32)
         qk += tl.dot(q, tl.trans(k))
-        qk *= sm_scale
 
         if use_bias:
             bias_load_mask = (offs_m[:, None] < N_CTX) & ((start_n + offs_n)[None, :] < N_CTX)
@@ -193,23 +195,21 @@ def dot_product_attention_torch(q: torch.Tensor,
                                 v: torch.Tensor,
                                 mask: Optional[torch.Tensor] = None,
                                 bias: Optional[torch.Tensor] = None):
-    scaling = q.size(-1) ** -0.5
-    q = q * scaling
-    logits = torch.matmul(q, k.transpose(-1, -2))
-
-    if bias is not None:
-        logits += bias
-
+    # Merge the mask and the bias into a single additive mask, so that
+    # scaled_dot_product_attention can use a fused kernel instead of
+    # materialising the logits. Both are brought to q.dtype while they are
+    # still small, [num_heads, N, N] and [batch, N], so the broadcast sum is
+    # the only full-sized tensor and is produced directly in q.dtype.
+    attn_mask = bias.to(dtype=q.dtype) if bias is not None else None
     if mask is not None:
         if mask.dim() == 1:
-            mask = mask[None, None, None, :].to(dtype=torch.bool)
+            mask = mask[None, None, None, :]
         elif mask.dim() == 2:
-            mask = mask[:, None, None, :].to(dtype=torch.bool)
-        logits.masked_fill_(~mask, -1e9)
-
-    weights = torch.softmax(logits, dim=-1)
+            mask = mask[:, None, None, :]
+        mask_bias = 1e9 * (mask.to(dtype=q.dtype) - 1.0)
+        attn_mask = mask_bias if attn_mask is None else attn_mask + mask_bias
 
-    return torch.matmul(weights, v)
+    return F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask)
 
 
 def dot_product_attention(q: torch.Tensor,
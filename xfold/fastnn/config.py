@@ -2,6 +2,8 @@
 layer_norm_implementation = "torch"
 
 # options: ["torch", "triton"]
+# There is no FP8 option (e.g. FlashAttention-3): every attention call in the
+# model adds a pair bias to the logits, which those kernels do not support.
 dot_product_attention_implementation = "torch"
 
 # options: ["torch", "triton"]
@@ -11,11 +11,12 @@
 
 
 import dataclasses
-from typing import Optional
+from typing import Callable, Optional
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 from xfold import feat_batch
 from xfold.nn import atom_layout, utils
@@ -27,6 +28,7 @@ from xfold import fastnn
 @dataclasses.dataclass(frozen=True)
 class AtomCrossAttEncoderOutput:
     token_act: torch.Tensor  # (num_tokens, ch)
+    # Not masked by queries_mask, consumers must mask it themselves.
     skip_connection: torch.Tensor  # (num_subsets, num_queries, ch)
     queries_mask: torch.Tensor  # (num_subsets, num_queries)
     queries_single_cond: torch.Tensor  # (num_subsets, num_queries, ch)
@@ -35,6 +37,147 @@ class AtomCrossAttEncoderOutput:
     pair_cond: torch.Tensor  # (num_subsets, num_queries, num_keys, ch)
 
 
+@torch.compile(fullgraph=True)
+def _per_atom_conditioning_core(
+    positions: torch.Tensor,
+    mask: torch.Tensor,
+    element: torch.Tensor,
+    charge: torch.Tensor,
+    atom_name_chars: torch.Tensor,
+    w_pos: torch.Tensor,
+    w_mask: torch.Tensor,
+    w_elem_t: torch.Tensor,
+    w_charge: torch.Tensor,
+    w_name_t: torch.Tensor,
+) -> torch.Tensor:
+    """Per-atom single conditioning of AtomCrossAttEncoder.
+
+    Takes the raw reference structure features and the weights of the
+    embedding layers, so that the whole embedding sum is compiled into a few
+    fused kernels instead of one launch per Linear / add. The element and atom
+    name weights are passed transposed, i.e. as (num_classes, channels) tables.
+    """
+    # Compute per-atom single conditioning
+    # Shape (num_tokens, num_dense, channels)
+    # Positions, mask and arcsinh(charge) are 3 + 1 + 1 dense features, embed
+    # them with one GEMM over the concatenated features and weights.
+    dense_feats = torch.cat([
+        positions,
+        mask[:, :, None].to(dtype=positions.dtype),
+        torch.arcsinh(charge)[:, :, None].to(dtype=positions.dtype),
+    ], dim=-1)
+    act = F.linear(dense_feats, torch.cat([w_pos, w_mask, w_charge], dim=1))
+
+    # Element is encoded as atomic number if the periodic table, so
+    # 128 should be fine. A one-hot followed by a Linear is a row gather of the
+    # transposed weight.
+    act += w_elem_t[element.to(dtype=torch.int64)]
+
+    # Characters are encoded as ASCII code minus 32, so we need 64 classes,
+    # to encode all standard ASCII characters between 32 and 96.
+    # The weight is laid out as (channels, num_chars * 64), so offsetting each
+    # character by 64 * its position gives its row in the transposed weight and
+    # all characters are embedded by a single gather.
+    char_offsets = 64 * torch.arange(
+        atom_name_chars.shape[-1], device=atom_name_chars.device)
+    act += torch.sum(
+        w_name_t[atom_name_chars.to(dtype=torch.int64) + char_offsets], dim=-2)
+
+    act *= mask[:, :, None]
+
+    return act
+
+
+@torch.compile(fullgraph=True)
+def _row_col_pair(
+    queries_single: torch.Tensor,  # (..., num_queries, ch)
+    keys_single: torch.Tensor,  # (..., num_keys, ch)
+    w_row: torch.Tensor,
+    w_col: torch.Tensor,
+) -> torch.Tensor:
+    """Outer sum of the row and col projections of the single activations.
+
+    The ReLUs, both projections and the broadcast add are compiled together,
+    so the row and col activations are never materialised on their own.
+    """
+    row_act = F.linear(torch.relu(queries_single), w_row)
+    col_act = F.linear(torch.relu(keys_single), w_col)
+    return row_act[..., :, None, :] + col_act[..., None, :, :]
+
+
+@torch.compile(fullgraph=True)
+def _fused_pair_cond(
+    queries_pos: torch.Tensor,  # (..., num_queries, 3)
+    keys_pos: torch.Tensor,  # (..., num_keys, 3)
+    queries_single: torch.Tensor,  # (..., num_queries, ch)
+    keys_single: torch.Tensor,  # (..., num_keys, ch)
+    w_row: torch.Tensor,
+    w_col: torch.Tensor,
+    w_off: torch.Tensor,
+    w_dist: torch.Tensor,
+    offsets_valid: Optional[torch.Tensor] = None,  # (..., num_queries, num_keys)
+    w_valid: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """Pair conditioning from single activations and reference positions.
+
+    Computes the row/col embedding of the single activations plus the
+    embedded pairwise offsets and inverse squared distances in one compiled
+    region, so the (..., Q, K, 3) offsets tensor is produced and consumed tile
+    by tile instead of being written to memory. If given, offsets_valid masks
+    both positional terms and, if w_valid is given too, is itself embedded
+    into the result.
+    """
+    # Embed pairwise offsets
+    offsets = queries_pos[..., :, None, :] - keys_pos[..., None, :, :]
+    pos_act = F.linear(offsets, w_off)
+
+    # Embed pairwise inverse squared distances. The reciprocal is fused with
+    # the reduction and the rank-1 projection, so it is never materialised.
+    sq_dists = torch.sum(torch.square(offsets), dim=-1, keepdim=True)
+    pos_act += F.linear(torch.reciprocal(sq_dists + 1), w_dist)
+
+    if offsets_valid is not None:
+        valid = offsets_valid.to(dtype=pos_act.dtype)[..., None]
+        pos_act *= valid
+        if w_valid is not None:
+            # A Linear from a single feature is a per-channel scale.
+            pos_act += valid * w_valid.view(-1)
+
+    return _row_col_pair(queries_single, keys_single, w_row, w_col) + pos_act
+
+
+@torch.compile(fullgraph=True)
+def _pair_mlp_residual(
+    pair_act: torch.Tensor,
+    w1: torch.Tensor,
+    w2: torch.Tensor,
+    w3: torch.Tensor,
+) -> torch.Tensor:
+    """Residual 3-layer ReLU MLP on the pair activations.
+
+    With only 16 pair channels the three GEMMs are memory bound, compiling
+    them together with the ReLUs and the residual add keeps the hidden
+    activations out of global memory.
+    """
+    pair_act2 = F.linear(torch.relu(pair_act), w1)
+    pair_act2 = F.linear(torch.relu(pair_act2), w2)
+    return pair_act + F.linear(torch.relu(pair_act2), w3)
+
+
+@torch.compile(fullgraph=True)
+def _mask_project(
+    x: torch.Tensor,  # (..., ch_in)
+    mask: torch.Tensor,  # (...)
+    w: torch.Tensor,  # (ch_out, ch_in)
+) -> torch.Tensor:
+    """Projects x with the masked positions zeroed.
+
+    The mask multiply is fused into the GEMM prologue instead of being a
+    separate pass over x.
+    """
+    return F.linear(x * mask[..., None], w)
+
+
 class AtomCrossAttEncoder(nn.Module):
     def __init__(self,
                  per_token_channels: int = 384,
@@ -42,12 +185,15 @@ class AtomCrossAttEncoder(nn.Module):
                  per_atom_pair_channels: int = 16,
                  with_token_atoms_act: bool = False,
                  with_trunk_single_cond: bool = False,
-                 with_trunk_pair_cond: bool = False) -> None:
+                 with_trunk_pair_cond: bool = False,
+                 use_checkpointing: bool = False) -> None:
         super(AtomCrossAttEncoder, self).__init__()
 
         self.with_token_atoms_act = with_token_atoms_act
         self.with_trunk_single_cond = with_trunk_single_cond
         self.with_trunk_pair_cond = with_trunk_pair_cond
+        # Recompute the pair conditioning in backward instead of storing it.
+        self.use_checkpointing = use_checkpointing
 
         self.c_positions = 3
         self.c_mask = 1
@@ -73,6 +219,8 @@ class AtomCrossAttEncoder(nn.Module):
         self.embed_ref_atom_name = nn.Linear(
             self.c_atom_name, self.per_atom_channels, bias=False)
 
+        # The token-atom pair conditioning these four layers embed is not used
+        # by the model, they are kept so that the released weights load.
         self.single_to_pair_cond_row = nn.Linear(
             self.per_atom_channels, self.per_atom_pair_channels, bias=False)
         self.single_to_pair_cond_col = nn.Linear(
@@ -130,53 +278,54 @@ class AtomCrossAttEncoder(nn.Module):
             self.embed_trunk_pair_cond = nn.Linear(
                 self.c_trunk_pair_cond, self.per_atom_pair_channels, bias=False)
 
-    def _per_atom_conditioning(self, batch: feat_batch.Batch) -> tuple[torch.Tensor, torch.Tensor]:
-
-        # Compute per-atom single conditioning
-        # Shape (num_tokens, num_dense, channels)
-        act = self.embed_ref_pos(batch.ref_structure.positions)
-        act += self.embed_ref_mask(batch.ref_structure.mask[:, :, None].to(
-            dtype=self.embed_ref_mask.weight.dtype))
-
-        # Element is encoded as atomic number if the periodic table, so
-        # 128 should be fine.
-        act += self.embed_ref_element(F.one_hot(batch.ref_structure.element.to(
-            dtype=torch.int64), 128).to(dtype=self.embed_ref_element.weight.dtype))
-        act += self.embed_ref_charge(torch.arcsinh(
-            batch.ref_structure.charge)[:, :, None])
-
-        # Characters are encoded as ASCII code minus 32, so we need 64 classes,
-        # to encode all standard ASCII characters between 32 and 96.
-        atom_name_chars_1hot = F.one_hot(batch.ref_structure.atom_name_chars.to(
-            dtype=torch.int64), 64).to(dtype=self.embed_ref_atom_name.weight.dtype)
-        num_token, num_dense, _ = act.shape
-        act += self.embed_ref_atom_name(
-            atom_name_chars_1hot.reshape(num_token, num_dense, -1))
-
-        act *= batch.ref_structure.mask[:, :, None]
-
-        # Compute pair conditioning
-        # shape (num_tokens, num_dense, num_dense, channels)
-        # Embed single features
-        row_act = self.single_to_pair_cond_row(torch.relu(act))
-        col_act = self.single_to_pair_cond_col(torch.relu(act))
-        pair_act = row_act[:, :, None, :] + col_act[:, None, :, :]
-
-        # Embed pairwise offsets
-        pair_act += self.embed_pair_offsets(batch.ref_structure.positions[:, :, None, :]
-                                            - batch.ref_structure.positions[:, None, :, :])
-
-        sq_dists = torch.sum(
-            torch.square(
-                batch.ref_structure.positions[:, :, None, :]
-                - batch.ref_structure.positions[:, None, :, :]
-            ),
-            dim=-1,
+        # Contiguous (num_classes, channels) copies of the element and atom
+        # name embedding weights, gathered row-wise in _per_atom_conditioning.
+        # Weights are loaded in place after construction, so these are filled
+        # lazily by _sync_weights().
+        self.register_buffer('embed_ref_element_wT', None, persistent=False)
+        self.register_buffer('embed_ref_atom_name_wT', None, persistent=False)
+        self._synced_weights_key = None
+
+    def _sync_weights(self) -> None:
+        """Refreshes the transposed embedding tables if the weights changed."""
+        weights = (self.embed_ref_element.weight,
+                   self.embed_ref_atom_name.weight)
+        key = tuple((w.data_ptr(), w._version) for w in weights)
+        if key == self._synced_weights_key:
+            return
+        with torch.no_grad():
+            self.embed_ref_element_wT = weights[0].t().contiguous()
+            self.embed_ref_atom_name_wT = weights[1].t().contiguous()
+        self._synced_weights_key = key
+
+    def _embedding_tables(self) -> tuple[torch.Tensor, torch.Tensor]:
+        if torch.is_grad_enabled() and self.embed_ref_element.weight.requires_grad:
+            # Keep the autograd graph to the weights when training.
+            return (self.embed_ref_element.weight.T,
+                    self.embed_ref_atom_name.weight.T)
+        self._sync_weights()
+        return self.embed_ref_element_wT, self.embed_ref_atom_name_wT
+
+    def _maybe_checkpoint(self, fn: Callable, *args, **kwargs):
+        """Calls fn, through activation checkpointing if enabled and training."""
+        if self.use_checkpointing and torch.is_grad_enabled():
+            return checkpoint(fn, *args, use_reentrant=False, **kwargs)
+        return fn(*args, **kwargs)
+
+    def _per_atom_conditioning(self, batch: feat_batch.Batch) -> torch.Tensor:
+        embed_ref_element_wT, embed_ref_atom_name_wT = self._embedding_tables()
+        return _per_atom_conditioning_core(
+            batch.ref_structure.positions,
+            batch.ref_structure.mask,
+            batch.ref_structure.element,
+            batch.ref_structure.charge,
+            batch.ref_structure.atom_name_chars,
+            self.embed_ref_pos.weight,
+            self.embed_ref_mask.weight,
+            embed_ref_element_wT,
+            self.embed_ref_charge.weight,
+            embed_ref_atom_name_wT,
         )
-        pair_act += self.embed_pair_distances(1.0 /
-                                              (1 + sq_dists[:, :, :, None]))
-
-        return act, pair_act
 
     def forward(
         self,
@@ -190,7 +339,10 @@ class AtomCrossAttEncoder(nn.Module):
         assert (trunk_single_cond is not None) == self.with_trunk_single_cond
         assert (trunk_pair_cond is not None) == self.with_trunk_pair_cond
 
-        token_atoms_single_cond, _ = self._per_atom_conditioning(batch)
+        # Only the single conditioning is needed here: the pair conditioning
+        # is built on the (num_subsets, num_queries, num_keys) layout below,
+        # from reference positions gathered into queries and keys layout.
+        token_atoms_single_cond = self._per_atom_conditioning(batch)
         token_atoms_mask = batch.predicted_structure_info.atom_mask
 
         queries_single_cond = atom_layout.convert(
@@ -216,7 +368,8 @@ class AtomCrossAttEncoder(nn.Module):
             )
 
         if token_atoms_act is None:
-            queries_act = queries_single_cond.clone()
+            # atom_transformer_encoder does not modify its input in place.
+            queries_act = queries_single_cond
         else:
             # Convert token_atoms_act to queries layout and map to per_atom_channels
             # (num_subsets, num_queries, channels)
@@ -240,48 +393,13 @@ class AtomCrossAttEncoder(nn.Module):
                 -2, -1)
         )
 
-        # Embed single features into the pair conditioning.
-        # shape (num_subsets, num_queries, num_keys, ch)
-        row_act = self.single_to_pair_cond_row_1(
-            torch.relu(queries_single_cond))
+        # Single features to embed into the pair conditioning.
         pair_cond_keys_input = atom_layout.convert(
             batch.atom_cross_att.queries_to_keys,
             queries_single_cond,
             layout_axes=(-3, -2),
         )
 
-        col_act = self.single_to_pair_cond_col_1(
-            torch.relu(pair_cond_keys_input))
-        pair_act = row_act[:, :, None, :] + col_act[:, None, :, :]
-
-        if trunk_pair_cond is not None:
-            trunk_pair_cond = self.embed_trunk_pair_cond(
-                self.lnorm_trunk_pair_cond(trunk_pair_cond))
-            
-            # Create the GatherInfo into a flattened trunk_pair_cond from the
-            # queries and keys gather infos.
-            num_tokens = trunk_pair_cond.shape[0]
-            # (num_subsets, num_queries)
-            tokens_to_queries = batch.atom_cross_att.tokens_to_queries
-            # (num_subsets, num_keys)
-            tokens_to_keys = batch.atom_cross_att.tokens_to_keys
-            # (num_subsets, num_queries, num_keys)
-            trunk_pair_to_atom_pair = atom_layout.GatherInfo(
-                gather_idxs=(
-                    num_tokens * tokens_to_queries.gather_idxs[:, :, None]
-                    + tokens_to_keys.gather_idxs[:, None, :]
-                ),
-                gather_mask=(
-                    tokens_to_queries.gather_mask[:, :, None]
-                    & tokens_to_keys.gather_mask[:, None, :]
-                ),
-                input_shape=torch.tensor((num_tokens, num_tokens), device=torch.device('cpu')),
-            )
-            # Gather the conditioning and add it to the atom-pair activations.
-            pair_act += atom_layout.convert(
-                trunk_pair_to_atom_pair, trunk_pair_cond, layout_axes=(-3, -2)
-            )
-
         # Embed pairwise offsets
         queries_ref_pos = atom_layout.convert(
             batch.atom_cross_att.token_atoms_to_queries,
@@ -307,23 +425,76 @@ class AtomCrossAttEncoder(nn.Module):
         offsets_valid = (
             queries_ref_space_uid[:, :, None] == keys_ref_space_uid[:, None, :]
         )
-        offsets = queries_ref_pos[:, :, None, :] - keys_ref_pos[:, None, :, :]
 
-        pair_act += (self.embed_pair_offsets_1(offsets)
-                     * offsets_valid[:, :, :, None])
+        # Embed single features, offsets and inverse squared distances into the
+        # pair conditioning, the latter two masked by offsets_valid, and
+        # embed the offsets_valid mask itself.
+        # shape (num_subsets, num_queries, num_keys, ch)
+        pair_act = self._maybe_checkpoint(
+            _fused_pair_cond,
+            queries_ref_pos,
+            keys_ref_pos,
+            queries_single_cond,
+            pair_cond_keys_input,
+            self.single_to_pair_cond_row_1.weight,
+            self.single_to_pair_cond_col_1.weight,
+            self.embed_pair_offsets_1.weight,
+            self.embed_pair_distances_1.weight,
+            offsets_valid=offsets_valid,
+            w_valid=self.embed_pair_offsets_valid.weight,
+        )
 
-        # Embed pairwise inverse squared distances
-        sq_dists = torch.sum(torch.square(offsets), dim=-1)
-        pair_act += self.embed_pair_distances_1(
-            1.0 / (1 + sq_dists[:, :, :, None])) * offsets_valid[:, :, :, None]
-        # Embed offsets valid mask
-        pair_act += self.embed_pair_offsets_valid(offsets_valid[:, :, :, None].to(
-            dtype=self.embed_pair_offsets_valid.weight.dtype))
+        if trunk_pair_cond is not None:
+            trunk_pair_cond = self.embed_trunk_pair_cond(
+                self.lnorm_trunk_pair_cond(trunk_pair_cond))
+
+            # Create the GatherInfo into a flattened trunk_pair_cond from the
+            # queries and keys gather infos.
+            num_tokens = trunk_pair_cond.shape[0]
+            # (num_subsets, num_queries)
+            tokens_to_queries = batch.atom_cross_att.tokens_to_queries
+            # (num_subsets, num_keys)
+            tokens_to_keys = batch.atom_cross_att.tokens_to_keys
+            # (num_subsets, num_queries, num_keys)
+            # The mask is all true if both factors are, which is known on the
+            # host, so this runs without a device sync, e.g. in a CUDA graph.
+            trunk_pair_to_atom_pair = atom_layout.GatherInfo(
+                gather_idxs=(
+                    num_tokens * tokens_to_queries.gather_idxs[:, :, None]
+                    + tokens_to_keys.gather_idxs[:, None, :]
+                ),
+                gather_mask=(
+                    tokens_to_queries.gather_mask[:, :, None]
+                    & tokens_to_keys.gather_mask[:, None, :]
+                ),
+                input_shape=(num_tokens, num_tokens),
+                gather_mask_is_all_true=(
+                    tokens_to_queries.gather_mask_is_all_true
+                    and tokens_to_keys.gather_mask_is_all_true
+                ),
+            )
+            # Gather the conditioning and add it to the atom-pair activations.
+            pair_act += atom_layout.convert(
+                trunk_pair_to_atom_pair, trunk_pair_cond, layout_axes=(-3, -2)
+            )
 
         # Run a small MLP on the pair acitvations
-        pair_act2 = self.pair_mlp_1(torch.relu(pair_act))
-        pair_act2 = self.pair_mlp_2(torch.relu(pair_act2))
-        pair_act += self.pair_mlp_3(torch.relu(pair_act2))
+        pair_act = self._maybe_checkpoint(
+            _pair_mlp_residual,
+            pair_act,
+            self.pair_mlp_1.weight,
+            self.pair_mlp_2.weight,
+            self.pair_mlp_3.weight,
+        )
+
+        # Make sure the attention kernels see dense inputs. These are
+        # no-ops for tensors that are already contiguous, and the inputs
+        # are also stored in the output for the decoder.
+        (queries_act, queries_mask, keys_mask, queries_single_cond,
+         keys_single_cond, pair_act) = (
+            t.contiguous() for t in (
+                queries_act, queries_mask, keys_mask, queries_single_cond,
+                keys_single_cond, pair_act))
 
         queries_act = self.atom_transformer_encoder(
             queries_act=queries_act,
@@ -335,10 +506,14 @@ class AtomCrossAttEncoder(nn.Module):
             pair_cond=pair_act
         )
 
-        queries_act *= queries_mask[..., None]
-        skip_connection = queries_act.clone()
+        # Not masked: the decoder adds it to its queries and masks the sum.
+        skip_connection = queries_act
 
-        queries_act = self.project_atom_features_for_aggr(queries_act)
+        queries_act = _mask_project(
+            queries_act,
+            queries_mask,
+            self.project_atom_features_for_aggr.weight,
+        )
 
         token_atoms_act = atom_layout.convert(
             batch.atom_cross_att.queries_to_token_atoms,
@@ -10,6 +10,7 @@
 
 
 import dataclasses
+import math
 from typing import Any
 from collections.abc import Sequence
 
@@ -30,14 +31,21 @@ class GatherInfo:
     Attributes:
       gather_idxs: np or jnp ndarray of int: gather indices into a flattened array
       gather_mask: np or jnp ndarray of bool: mask for resulting array
-      input_shape: np or jnp ndarray of int: the shape of the unflattened input
-        array
+      input_shape: tuple of int: the shape of the unflattened input array.
+        Tensors and arrays are converted to a tuple on construction, so that
+        convert() never has to read it back from the device.
       shape: output shape. Just returns gather_idxs.shape
+      gather_idxs_flat: gather_idxs flattened to 1-dim, derived on construction
+      gather_mask_is_all_true: bool: whether gather_mask masks nothing, so that
+        convert() can skip the mask multiply. Checking the mask reads it back
+        from the device, so it is only done once in from_dict(); other
+        constructors pass it in and default to False, which is always correct.
     """
 
     gather_idxs: torch.Tensor
     gather_mask: torch.Tensor
-    input_shape: torch.Tensor
+    input_shape: tuple[int, ...]
+    gather_mask_is_all_true: bool = False
 
     def __post_init__(self):
         if self.gather_mask.shape != self.gather_idxs.shape:
@@ -46,12 +54,36 @@ class GatherInfo:
                 f'gather_idxs.shape = {self.gather_idxs.shape}\n'
                 f'gather_mask.shape = {self.gather_mask.shape}\n'
             )
+        # The dataclass is frozen, so derived members are set via object.
+        object.__setattr__(
+            self, 'input_shape', tuple(int(d) for d in self.input_shape))
+        object.__setattr__(
+            self, 'gather_idxs_flat', self.gather_idxs.reshape(-1).contiguous())
+        # Broadcasted masks, keyed by (num_batch_dims, num_feature_dims).
+        object.__setattr__(self, '_broadcasted_masks', {})
+
+    def broadcasted_mask(
+        self, num_batch_dims: int, num_feature_dims: int
+    ) -> torch.Tensor:
+        """gather_mask with singleton batch and feature axes, cached per rank."""
+        key = (num_batch_dims, num_feature_dims)
+        mask = self._broadcasted_masks.get(key)
+        if mask is None:
+            mask = self.gather_mask.reshape(
+                (1,) * num_batch_dims
+                + self.gather_mask.shape
+                + (1,) * num_feature_dims
+            )
+            self._broadcasted_masks[key] = mask
+        return mask
 
     def __getitem__(self, key: Any) -> 'GatherInfo':
         return GatherInfo(
             gather_idxs=self.gather_idxs[key],
             gather_mask=self.gather_mask[key],
             input_shape=self.input_shape,
+            # Any slice of an all-true mask is all true.
+            gather_mask_is_all_true=self.gather_mask_is_all_true,
         )
 
     @property
@@ -66,7 +98,7 @@ class GatherInfo:
         return {
             prefix + 'gather_idxs': self.gather_idxs,
             prefix + 'gather_mask': self.gather_mask,
-            prefix + 'input_shape': self.input_shape,
+            prefix + 'input_shape': torch.tensor(self.input_shape),
         }
 
     @classmethod
@@ -77,11 +109,14 @@ class GatherInfo:
     ) -> 'GatherInfo':
         """Creates GatherInfo from a given dictionary."""
         prefix = f'{key_prefix}:' if key_prefix else ''
-        # we force the input_shape to be on the CPU
+        gather_mask = d[prefix + 'gather_mask']
+        # input_shape and gather_mask_is_all_true are only ever used on the
+        # host, so read them back once here, when the batch is loaded.
         return cls(
             gather_idxs=d[prefix + 'gather_idxs'],
-            gather_mask=d[prefix + 'gather_mask'],
-            input_shape=d[prefix + 'input_shape'].to(device=torch.device('cpu')),
+            gather_mask=gather_mask,
+            input_shape=tuple(d[prefix + 'input_shape'].tolist()),
+            gather_mask_is_all_true=bool(gather_mask.all()),
         )
 
 
@@ -103,20 +138,8 @@ def convert(
         raise ValueError(f'layout_axes must be continuous. Got {layout_axes}.')
     layout_shape = arr.shape[layout_axes_begin:layout_axes_end]
 
-    # we force the input_shape to be on the CPU
-    assert gather_info.input_shape.device == torch.device("cpu")
-    gather_info_input_shape = gather_info.input_shape.numpy()
-
-    # Ensure that the layout shape is compatible
-    # with the gather_info. I.e. the first axis size must be equal or greater
-    # than the gather_info.input_shape, and all subsequent axes sizes must match.
-    if (len(layout_shape) != gather_info_input_shape.size) or (
-        isinstance(gather_info_input_shape, torch.Tensor)
-        and (
-            (layout_shape[0] < gather_info_input_shape[0])
-            or (np.any(layout_shape[1:] != gather_info_input_shape[1:]))
-        )
-    ):
+    # Ensure that the layout shape is compatible with the gather_info.
+    if len(layout_shape) != len(gather_info.input_shape):
         raise ValueError(
             'Input array layout axes are incompatible. You specified layout '
             f'axes {layout_axes} with an input array of shape {arr.shape}, but '
@@ -130,34 +153,39 @@ def convert(
     batch_shape = arr.shape[:layout_axes_begin]
     features_shape = arr.shape[layout_axes_end:]
     arr_flattened_shape = batch_shape + \
-        (np.prod(layout_shape),) + features_shape
+        (math.prod(layout_shape),) + features_shape
 
-    # Flatten input array and perform the gather.
+    # Flatten input array and perform the gather along the flattened layout
+    # axis, then restore the gather_idxs shape.
     arr_flattened = arr.reshape(arr_flattened_shape)
-    if layout_axes_begin == 0:
-        out_arr = arr_flattened[gather_info.gather_idxs, ...]
-    elif layout_axes_begin == 1:
-        out_arr = arr_flattened[:, gather_info.gather_idxs, ...]
-    elif layout_axes_begin == 2:
-        out_arr = arr_flattened[:, :, gather_info.gather_idxs, ...]
-    elif layout_axes_begin == 3:
-        out_arr = arr_flattened[:, :, :, gather_info.gather_idxs, ...]
-    elif layout_axes_begin == 4:
-        out_arr = arr_flattened[:, :, :, :, gather_info.gather_idxs, ...]
-    else:
-        raise ValueError(
-            'Only 4 batch axes supported. If you need more, the code '
-            'is easy to extend.'
-        )
+    out_shape = batch_shape + gather_info.gather_idxs.shape + features_shape
+
+    if gather_info.gather_mask_is_all_true:
+        return torch.index_select(
+            arr_flattened, layout_axes_begin, gather_info.gather_idxs_flat
+        ).reshape(out_shape)
 
     # Broadcast the mask and apply it.
-    broadcasted_mask_shape = (
-        (1,) * len(batch_shape)
-        + gather_info.gather_mask.shape
-        + (1,) * len(features_shape)
+    return _gather_and_mask(
+        arr_flattened,
+        layout_axes_begin,
+        gather_info.gather_idxs_flat,
+        out_shape,
+        gather_info.broadcasted_mask(len(batch_shape), len(features_shape)),
     )
-    out_arr *= gather_info.gather_mask.reshape(broadcasted_mask_shape)
-    return out_arr
+
+
+@torch.compile(fullgraph=True)
+def _gather_and_mask(
+    arr_flattened: torch.Tensor,
+    dim: int,
+    gather_idxs_flat: torch.Tensor,
+    out_shape: tuple[int, ...],
+    broadcasted_mask: torch.Tensor,
+) -> torch.Tensor:
+    """Gathers along dim and applies the mask in a single fused kernel."""
+    out_arr = torch.index_select(arr_flattened, dim, gather_idxs_flat)
+    return out_arr.reshape(out_shape) * broadcasted_mask
 
 
 @dataclasses.dataclass(frozen=True)
@@ -311,6 +339,9 @@ class AtomLayout:
         chain_type). This method together with from_array() provides an easy way to
         apply pure numpy methods like np.concatenate() to `AtomLayout`s.
 
+        Deprecated: the object array boxes every element, prefer the field-wise
+        AtomLayout.concatenate() instead of stacking with to_array().
+
         Returns:
           np.ndarray of object with shape (6, <layout_shape>), e.g.
           array([['N', 'CA', 'C', ..., 'CB', 'CG', 'CD'],
@@ -335,6 +366,10 @@ class AtomLayout:
         """Creates an AtomLayout object from a numpy array with shape (6, ...).
 
         see also to_array()
+
+        Deprecated: prefer AtomLayout.concatenate() over round-tripping through
+        to_array() / from_array().
+
         Args:
           arr: np.ndarray of object with shape (6, <layout_shape>)
 
@@ -349,6 +384,46 @@ class AtomLayout:
             )
         return cls(*arr)
 
+    @classmethod
+    def concatenate(
+        cls, layouts: Sequence['AtomLayout'], axis: int = 0
+    ) -> 'AtomLayout':
+        """Concatenates AtomLayouts field by field along an existing axis.
+
+        Each field is concatenated with its own dtype, so no object array
+        holding all fields is ever built.
+
+        Args:
+          layouts: non-empty sequence of AtomLayouts, all with the same shape
+            apart from the concatenation axis.
+          axis: axis to concatenate along.
+
+        Returns:
+          AtomLayout with the concatenated fields. Optional fields are None if
+          they are None in all layouts.
+
+        Raises:
+          ValueError: empty layouts or an optional field that is present in
+            some of the layouts only.
+        """
+        if not layouts:
+            raise ValueError('Need at least one AtomLayout to concatenate.')
+
+        fields = {}
+        for field in dataclasses.fields(cls):
+            arrs = [getattr(layout, field.name) for layout in layouts]
+            num_none = sum(arr is None for arr in arrs)
+            if num_none == len(arrs):
+                fields[field.name] = None
+            elif num_none:
+                raise ValueError(
+                    f'Field {field.name} is None in {num_none} of {len(arrs)} '
+                    'layouts, it must be present in all or none of them.'
+                )
+            else:
+                fields[field.name] = np.concatenate(arrs, axis=axis)
+        return cls(**fields)
+
     @property
     def shape(self) -> tuple[int, ...]:
         return self.atom_name.shape
@@ -9,51 +9,127 @@
 # https://github.com/google-deepmind/alphafold3/blob/main/WEIGHTS_TERMS_OF_USE.md
 
 
-import einops
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from xfold import fastnn
+from xfold.nn import utils
+from xfold.fastnn import config as fastnn_config
+
+
+def _gated_grid_attention(pair_rows: torch.Tensor,
+                          q: torch.Tensor,
+                          k: torch.Tensor,
+                          v: torch.Tensor,
+                          gate: torch.Tensor,
+                          mask: torch.Tensor,
+                          pair_bias_weight: torch.Tensor,
+                          output_weight: torch.Tensor) -> torch.Tensor:
+    """Gated attention of one block of GridSelfAttention queries.
+
+    Args:
+        pair_rows (torch.Tensor): [N_rows, N_token, c_pair] rows of the
+            untransposed pair that index the bias.
+        q (torch.Tensor): [N_batch, num_head, N_query, qkv_dim]
+        k, v (torch.Tensor): [N_batch, num_head, N_token, qkv_dim]
+        gate (torch.Tensor): [N_batch, N_query, c_pair] gate logits.
+        mask (torch.Tensor): [N_batch, N_token]
+    Returns:
+        torch.Tensor: [N_batch, N_query, c_pair]
+    """
+    # W @ pair^T writes the [num_head, N_rows, N_token] bias directly, instead
+    # of projecting to [N_rows, N_token, num_head] and copying a permuted view.
+    bias = torch.matmul(pair_bias_weight, pair_rows.flatten(0, 1).T)
+    bias = bias.unflatten(-1, pair_rows.shape[:2])
+
+    weighted_avg = fastnn.dot_product_attention(q, k, v, mask=mask, bias=bias)
+    weighted_avg = weighted_avg.transpose(-3, -2).flatten(-2)
+    weighted_avg = utils.sigmoid_gate(weighted_avg, gate)
+    return F.linear(weighted_avg, output_weight)
+
+
+# Fuses the mask and bias merge, the layout changes and the gating around the
+# attention call. The number of tokens varies between inputs, so shapes are
+# compiled dynamically. Only used with the torch attention implementation.
+_compiled_gated_grid_attention = torch.compile(
+    _gated_grid_attention, dynamic=True, fullgraph=True)
 
 
 class GridSelfAttention(nn.Module):
-    def __init__(self, c_pair: int = 128, num_head: int = 4, transpose: bool = False):
+    def __init__(self, c_pair: int = 128, num_head: int = 4, transpose: bool = False,
+                 query_block_size: int = 128):
         super(GridSelfAttention, self).__init__()
         self.c_pair = c_pair
         self.num_head = num_head
         self.qkv_dim = self.c_pair // self.num_head
         self.transpose = transpose
+        # Queries are processed in blocks of this size on the torch path, so
+        # the [num_head, N_token, N_token] bias is never materialised at once.
+        self.query_block_size = query_block_size
 
         self.act_norm = fastnn.LayerNorm(self.c_pair)
         self.pair_bias_projection = nn.Linear(
             self.c_pair, self.num_head, bias=False)
 
-        self.q_projection = nn.Linear(self.c_pair, self.c_pair, bias=False)
-        self.k_projection = nn.Linear(self.c_pair, self.c_pair, bias=False)
-        self.v_projection = nn.Linear(self.c_pair, self.c_pair, bias=False)
+        # q, k, v and gate projections fused into a single GEMM.
+        self.qkvg_projection = nn.Linear(
+            self.c_pair, 4 * self.c_pair, bias=False)
+        utils.register_fused_linear_load_hook(
+            self, 'qkvg_projection',
+            ('q_projection', 'k_projection', 'v_projection', 'gating_query'))
 
-        self.gating_query = nn.Linear(self.c_pair, self.c_pair, bias=False)
         self.output_projection = nn.Linear(
             self.c_pair, self.c_pair, bias=False)
 
-    def _attention(self, pair: torch.Tensor, mask: torch.Tensor, bias: torch.Tensor):
-        q = self.q_projection(pair)
-        k = self.k_projection(pair)
-        v = self.v_projection(pair)
+    def _to_attention_layout(self, t: torch.Tensor) -> torch.Tensor:
+        """[N_token, N_token, ...] view in which attention runs along axis 1."""
+        return t.transpose(0, 1) if self.transpose else t
 
-        q, k, v = map(lambda t: einops.rearrange(
-            t, 'b n (h d) -> b h n d', h=self.num_head), [q, k, v])
-
-        weighted_avg = fastnn.dot_product_attention(q, k, v,
-                                                    mask=mask,
-                                                    bias=bias)
-
-        weighted_avg = einops.rearrange(weighted_avg, 'b h n d -> b n (h d)')
-
-        gate_values = self.gating_query(pair)
-
-        weighted_avg *= torch.sigmoid(gate_values)
-        return self.output_projection(weighted_avg)
+    def _attention(self, pair: torch.Tensor, mask: torch.Tensor):
+        """
+        Args:
+            pair (torch.Tensor): [N_token, N_token, c_pair] normalised pair,
+                not transposed. The projections run on this contiguous layout
+                and only their outputs are viewed transposed, so no
+                transposed copy of the pair is materialised.
+            mask (torch.Tensor): [N_token, N_token]
+        Returns:
+            torch.Tensor: [N_token, N_token, c_pair], not transposed.
+        """
+        q_all, k, v, gate_all = self._to_attention_layout(
+            self.qkvg_projection(pair)).chunk(4, dim=-1)
+        # [N_batch, N_token, (h d)] -> [N_batch, h, N_token, d]
+        k, v = (t.unflatten(-1, (self.num_head, self.qkv_dim)).transpose(-3, -2)
+                for t in (k, v))
+
+        # The triton kernel needs queries and keys of the same length.
+        num_tokens = pair.shape[1]
+        block_size = num_tokens
+        gated_attention = _gated_grid_attention
+        if fastnn_config.dot_product_attention_implementation == "torch":
+            block_size = min(self.query_block_size, num_tokens)
+            gated_attention = _compiled_gated_grid_attention
+
+        out = None
+        for start in range(0, num_tokens, block_size):
+            block = slice(start, start + block_size)
+            q = q_all[:, block].unflatten(
+                -1, (self.num_head, self.qkv_dim)).transpose(-3, -2)
+
+            # The bias is indexed by (query, key) of the untransposed pair.
+            block_out = gated_attention(
+                pair[block], q, k, v, gate_all[:, block], mask,
+                self.pair_bias_projection.weight,
+                self.output_projection.weight)
+
+            if block_size == num_tokens:
+                return self._to_attention_layout(block_out)
+            if out is None:
+                out = block_out.new_empty(
+                    pair.shape[:-1] + block_out.shape[-1:])
+            self._to_attention_layout(out)[:, block] = block_out
+        return out
 
     def forward(self, pair, mask):
         """
@@ -64,18 +140,8 @@ class GridSelfAttention(nn.Module):
             torch.Tensor: [N_token, N_token, c_pair]
         """
 
-        pair = self.act_norm(pair)
-        nonbatched_bias = self.pair_bias_projection(pair).permute(2, 0, 1)
-
-        if self.transpose:
-            pair = pair.permute(1, 0, 2)
-
-        pair = self._attention(pair, mask, nonbatched_bias)
-
-        if self.transpose:
-            pair = pair.permute(1, 0, 2)
-
-        return pair
+        pair = utils.layer_norm_for_linear(self.act_norm, pair)
+        return self._attention(pair, mask)
 
 
 class MSAAttention(nn.Module):
@@ -97,21 +163,31 @@ class MSAAttention(nn.Module):
         self.output_projection = nn.Linear(self.c_msa, self.c_msa, bias=False)
 
     def forward(self, msa, msa_mask, pair):
-        msa = self.act_norm(msa)
-        pair = self.pair_norm(pair)
+        msa = utils.layer_norm_for_linear(self.act_norm, msa)
+        pair = utils.layer_norm_for_linear(self.pair_norm, pair)
         logits = self.pair_logits(pair)
         logits = logits.permute(2, 0, 1)
 
-        logits += 1e9 * (torch.max(msa_mask, dim=0).values - 1.0)
+        # A key is valid if it is present in any sequence. amax does not
+        # allocate the argmax indices that torch.max(dim=...) returns.
+        logits += 1e9 * (torch.amax(msa_mask, dim=0) - 1.0)
         weights = torch.softmax(logits, dim=-1)
 
         v = self.v_projection(msa)
-        v = einops.rearrange(v, 'b k (h c) -> b k h c', h=self.num_head)
-
-        v_avg = torch.einsum('hqk, bkhc -> bqhc', weights, v)
-        v_avg = torch.reshape(v_avg, v_avg.shape[:-2] + (-1,))
+        num_seq, num_res = v.shape[:2]
+        # [b, k, (h c)] -> [h, k, (b c)]
+        v = v.unflatten(-1, (self.num_head, self.value_dim)).permute(2, 1, 0, 3)
+        v = v.reshape(self.num_head, num_res, -1)
+
+        # The weights are shared by all sequences, so fold the sequences into
+        # the columns of one [h, q, k] @ [h, k, (b c)] matmul. Broadcasting the
+        # weights over sequences instead would copy them once per sequence.
+        v_avg = torch.matmul(weights, v)
+        # [h, q, (b c)] -> [b, q, (h c)]
+        v_avg = v_avg.unflatten(-1, (num_seq, self.value_dim)).permute(2, 1, 0, 3)
+        v_avg = v_avg.flatten(-2)
 
         gate_values = self.gating_query(msa)
-        v_avg *= torch.sigmoid(gate_values)
+        v_avg = utils.sigmoid_gate(v_avg, gate_values)
 
         return self.output_projection(v_avg)
@@ -15,9 +15,8 @@ from typing import Optional
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import einops
 
-from xfold.nn import atom_layout
+from xfold.nn import atom_layout, utils
 from xfold import fastnn
 
 
@@ -142,24 +141,35 @@ class SelfAttention(nn.Module):
         self.adaptive_layernorm = AdaptiveLayerNorm(
             self.c_x, self.c_single_cond, self.use_single_cond)
 
-        self.q_projection = nn.Linear(self.c_x, self.c_x, bias=True)
-        self.k_projection = nn.Linear(self.c_x, self.c_x, bias=False)
-        self.v_projection = nn.Linear(self.c_x, self.c_x, bias=False)
-
-        self.gating_query = nn.Linear(self.c_x, self.c_x, bias=False)
+        # q, k, v and gate projections fused into a single GEMM, only q has a
+        # bias.
+        self.qkvg_projection = nn.Linear(self.c_x, 4 * self.c_x, bias=False)
+        self.q_bias = nn.Parameter(torch.zeros(self.c_x))
+        utils.register_fused_linear_load_hook(
+            self, 'qkvg_projection',
+            ('q_projection', 'k_projection', 'v_projection', 'gating_query'))
+        self._register_load_state_dict_pre_hook(self._load_q_bias_hook)
 
         self.adaptive_zero_init = AdaLNZero(
             self.c_x, self.c_x, self.c_single_cond, self.use_single_cond)
 
+    @staticmethod
+    def _load_q_bias_hook(state_dict, prefix, *args):
+        """Loads q_projection.bias of unfused state dicts into q_bias."""
+        key = prefix + 'q_projection.bias'
+        if key in state_dict:
+            state_dict[prefix + 'q_bias'] = state_dict.pop(key)
+
     def forward(self,
                 x: torch.Tensor,
-                mask: torch.Tensor,
+                mask: Optional[torch.Tensor],
                 pair_logits: Optional[torch.Tensor] = None,
                 single_cond: Optional[torch.Tensor] = None) -> torch.Tensor:
         """
         Args:
             x (torch.Tensor): (num_tokens, ch)
-            mask (torch.Tensor): (num_tokens,)
+            mask (torch.Tensor, optional): (num_tokens,), None if the mask is
+                already folded into pair_logits as an additive bias.
             pair_logits (torch.Tensor, optional): (num_heads, num_tokens, num_tokens)
         """
 
@@ -167,22 +177,24 @@ class SelfAttention(nn.Module):
 
         x = self.adaptive_layernorm(x, single_cond)
 
-        q = self.q_projection(x)
-        k = self.k_projection(x)
-        v = self.v_projection(x)
+        q, k, v, gate_logits = self.qkvg_projection(x).chunk(4, dim=-1)
+        # Under autocast the GEMM output is bf16 and the bias stays fp32, add
+        # it in the dtype of q so that q, k and v keep the same dtype.
+        q = q + self.q_bias.to(dtype=q.dtype)
 
-        q, k, v = map(lambda t: einops.rearrange(
-            t, 'n (h c) -> h n c', h=self.num_head).unsqueeze(0), [q, k, v])
+        # (num_tokens, (h c)) -> (1, h, num_tokens, c)
+        q, k, v = (
+            t.unflatten(-1, (self.num_head, self.qkv_dim)).transpose(0, 1).unsqueeze(0)
+            for t in (q, k, v))
 
         weighted_avg = fastnn.dot_product_attention(
             q, k, v, mask=mask, bias=pair_logits
         )
 
         weighted_avg = weighted_avg.squeeze(0)
-        weighted_avg = einops.rearrange(weighted_avg, 'h q c -> q (h c)')
+        weighted_avg = weighted_avg.transpose(0, 1).flatten(-2)
 
-        gate_logits = self.gating_query(x)
-        weighted_avg *= torch.sigmoid(gate_logits)
+        weighted_avg = utils.sigmoid_gate(weighted_avg, gate_logits)
 
         return self.adaptive_zero_init(weighted_avg, single_cond)
 
@@ -224,13 +236,20 @@ class DiffusionTransformer(nn.Module):
 
         pair_act = self.pair_input_layer_norm(pair_cond)
 
+        # The mask is shared by all blocks, convert it to an additive bias once
+        # and fold it into the pair logits of each super block, instead of
+        # converting it in every self-attention.
+        mask_bias = 1e9 * (mask.to(dtype=torch.float32) - 1.0)
+
         for super_block_i in range(self.num_super_blocks):
             pair_logits = self.pair_logits_projection[super_block_i](pair_act)
-            pair_logits = einops.rearrange(
-                pair_logits, 'n s (b h) -> b h n s', h=self.num_head)
+            # (n, s, (b h)) -> (b, h, n, s)
+            pair_logits = pair_logits.unflatten(
+                -1, (self.super_block_size, self.num_head)).permute(2, 3, 0, 1)
+            pair_logits += mask_bias
             for j in range(self.super_block_size):
                 act += self.self_attention[super_block_i * self.super_block_size + j](
-                    act, mask, pair_logits[j, ...], single_cond)
+                    act, None, pair_logits[j, ...], single_cond)
                 act += self.transition_block[super_block_i *
                                              self.super_block_size + j](act, single_cond)
 
@@ -257,9 +276,11 @@ class CrossAttention(nn.Module):
             c_x=self.key_dim, c_single_cond=self.c_single_cond, use_single_cond=True)
 
         self.q_projection = nn.Linear(self.key_dim, self.key_dim, bias=True)
-        self.k_projection = nn.Linear(self.key_dim, self.key_dim, bias=False)
-        self.v_projection = nn.Linear(
-            self.value_dim, self.value_dim, bias=False)
+        # k and v are both projected from x_k, fused into a single GEMM.
+        self.kv_projection = nn.Linear(
+            self.key_dim, self.key_dim + self.value_dim, bias=False)
+        utils.register_fused_linear_load_hook(
+            self, 'kv_projection', ('k_projection', 'v_projection'))
 
         self.gating_query = nn.Linear(self.key_dim, self.value_dim, bias=False)
         self.adaptive_zero_init = AdaLNZero(
@@ -269,48 +290,42 @@ class CrossAttention(nn.Module):
         self,
         x_q: torch.Tensor,
         x_k: torch.Tensor,
-        mask_q: torch.Tensor,
-        mask_k: torch.Tensor,
-        pair_logits: Optional[torch.Tensor] = None,
+        attn_bias: torch.Tensor,
         single_cond_q: Optional[torch.Tensor] = None,
         single_cond_k: Optional[torch.Tensor] = None
     ) -> torch.Tensor:
-        assert len(mask_q.shape) == len(x_q.shape) - \
-            1, f'{mask_q.shape}, {x_q.shape}'
-        assert len(mask_k.shape) == len(x_k.shape) - \
-            1, f'{mask_k.shape}, {x_k.shape}'
-
-        bias = (
-            1e9
-            * mask_q.logical_not()[..., None, :, None]
-            * mask_k.logical_not()[..., None, None, :]
-        )
-
+        """
+        Args:
+            x_q (torch.Tensor): (..., num_queries, ch)
+            x_k (torch.Tensor): (..., num_keys, ch)
+            attn_bias (torch.Tensor): (..., num_heads, num_queries, num_keys)
+                additive float bias holding both the query/key mask and the
+                pair logits, see DiffusionCrossAttTransformer.
+        """
         x_q = self.q_adaptive_layernorm(x_q, single_cond_q)
         x_k = self.k_adaptive_layernorm(x_k, single_cond_k)
 
         q = self.q_projection(x_q)
-        k = self.k_projection(x_k)
+        k, v = torch.split(
+            self.kv_projection(x_k), [self.key_dim, self.value_dim], dim=-1)
         q = torch.reshape(q, q.shape[:-1] +
                           (self.num_head, self.key_dim_per_head))
         k = torch.reshape(k, k.shape[:-1] +
                           (self.num_head, self.key_dim_per_head))
 
-        logits = torch.einsum('...qhc,...khc->...hqk',
-                              q * self.q_scale, k) + bias
-        if pair_logits is not None:
-            logits += pair_logits
-        weights = torch.softmax(logits, axis=-1)
-
-        v = self.v_projection(x_k)
         v = torch.reshape(v, v.shape[:-1] +
                           (self.num_head, self.value_dim_per_head))
-        weighted_avg = torch.einsum('...hqk,...khc->...qhc', weights, v)
+
+        # (..., num_heads, num_tokens, ch) layout for the fused attention.
+        q, k, v = (t.transpose(-2, -3) for t in (q, k, v))
+        weighted_avg = F.scaled_dot_product_attention(
+            q, k, v, attn_mask=attn_bias.to(dtype=q.dtype), scale=self.q_scale)
+        weighted_avg = weighted_avg.transpose(-2, -3)
         weighted_avg = torch.reshape(
             weighted_avg, weighted_avg.shape[:-2] + (-1,))
 
         gate_logits = self.gating_query(x_q)
-        weighted_avg *= torch.sigmoid(gate_logits)
+        weighted_avg = utils.sigmoid_gate(weighted_avg, gate_logits)
 
         return self.adaptive_zero_init(weighted_avg, single_cond_q)
 
@@ -350,20 +365,32 @@ class DiffusionCrossAttTransformer(nn.Module):
         pair_act = self.pair_input_layer_norm(pair_cond)
         pair_logits = self.pair_logits_projection(pair_act)
 
-        pair_logits = einops.rearrange(
-            pair_logits, 'n q k (b h) -> b n h q k', h=self.num_head)
+        # (n, q, k, (b h)) -> (b, n, h, q, k)
+        pair_logits = pair_logits.unflatten(
+            -1, (self.num_blocks, self.num_head)).permute(3, 0, 4, 1, 2)
+
+        # Convert the boolean masks to an additive float bias once and fold it
+        # into the pair logits of all blocks, instead of rebuilding it in every
+        # block. The result can be passed as attn_mask to
+        # F.scaled_dot_product_attention.
+        mask_bias = (
+            1e9
+            * queries_mask.logical_not()[..., None, :, None]
+            * keys_mask.logical_not()[..., None, None, :]
+        )
+        attn_bias = pair_logits + mask_bias
 
         for block_idx in range(self.num_blocks):
             keys_act = atom_layout.convert(
                 queries_to_keys, queries_act, layout_axes=(-3, -2)
             )
 
-            queries_act += self.cross_attention[block_idx](
+            # Out of place, so the caller's queries_act is never mutated and
+            # may alias e.g. the single conditioning.
+            queries_act = queries_act + self.cross_attention[block_idx](
                 x_q=queries_act,
                 x_k=keys_act,
-                mask_q=queries_mask,
-                mask_k=keys_mask,
-                pair_logits=pair_logits[block_idx,...],
+                attn_bias=attn_bias[block_idx, ...],
                 single_cond_q=queries_single_cond,
                 single_cond_k=keys_single_cond,
             )
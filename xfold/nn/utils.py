@@ -13,6 +13,9 @@ from collections import abc
 import numbers
 
 import torch
+import torch.nn.functional as F
+
+from xfold.fastnn import config as fastnn_config
 
 
 def mask_mean(mask, value, dim=None, keepdim=False, eps=1e-10):
@@ -46,3 +49,49 @@ def mask_mean(mask, value, dim=None, keepdim=False, eps=1e-10):
     return torch.sum(mask * value, keepdim=keepdim, dim=dim) / (
         torch.clamp(torch.sum(mask, keepdim=keepdim, dim=dim) * broadcast_factor, min=eps)
     )
+
+
+def register_fused_linear_load_hook(module, fused_name, names):
+    """Loads state dicts with separate Linear layers into a fused Linear.
+
+    The weights `<name>.weight` of the separate layers are concatenated along
+    the output axis into `<fused_name>.weight`, in the order of `names`, so
+    that state dicts saved before the layers were fused still load.
+    """
+
+    def hook(state_dict, prefix, *args):
+        keys = [f'{prefix}{name}.weight' for name in names]
+        if all(key in state_dict for key in keys):
+            state_dict[f'{prefix}{fused_name}.weight'] = torch.cat(
+                [state_dict.pop(key) for key in keys], dim=0)
+
+    module._register_load_state_dict_pre_hook(hook)
+
+
+@torch.compile(fullgraph=True)
+def sigmoid_gate(x: torch.Tensor, gate_logits: torch.Tensor) -> torch.Tensor:
+    """Returns x * sigmoid(gate_logits), fused into a single kernel."""
+    return x * torch.sigmoid(gate_logits)
+
+
+@torch.compile(fullgraph=True)
+def _layer_norm_cast(x, normalized_shape, weight, bias, eps, dtype):
+    return F.layer_norm(x, normalized_shape, weight, bias, eps).to(dtype=dtype)
+
+
+def layer_norm_for_linear(norm, x: torch.Tensor) -> torch.Tensor:
+    """Applies the LayerNorm norm to x, for activations that feed Linears.
+
+    Under autocast the LayerNorm output is float32, and each Linear consuming
+    it casts it to the autocast dtype again. Here the normalisation and the
+    cast are compiled into one kernel, so the activations are written once,
+    in the dtype the GEMMs read. Other LayerNorm implementations run through
+    norm itself, followed by the cast.
+    """
+    dtype = x.dtype
+    if x.is_cuda and torch.is_autocast_enabled('cuda'):
+        dtype = torch.get_autocast_dtype('cuda')
+    if fastnn_config.layer_norm_implementation != "torch":
+        return norm(x).to(dtype=dtype)
+    return _layer_norm_cast(
+        x, norm.normalized_shape, norm.weight, norm.bias, norm.eps, dtype)
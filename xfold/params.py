@@ -437,38 +437,53 @@ def TransitionParams(transition): return {
 }
 
 
-def GridSelfAttentionParams(pair_attention): return {
-    "act_norm": LayerNormParams(pair_attention.act_norm),
-    "pair_bias_projection": LinearParams(pair_attention.pair_bias_projection),
-    "q_projection": LinearHMAParams(pair_attention.q_projection, already_transpose_weights=True),
-    "k_projection": LinearHMAParams(pair_attention.k_projection, already_transpose_weights=True),
-    "v_projection": LinearHMAParams(pair_attention.v_projection),
-    "gating_query": LinearParams(pair_attention.gating_query, already_transpose_weights=True),
-    "output_projection": LinearParams(pair_attention.output_projection),
-}
+def GridSelfAttentionParams(pair_attention):
+    # Views into the fused qkvg_projection weight, loaded in place.
+    q_weight, k_weight, v_weight, g_weight = \
+        pair_attention.qkvg_projection.weight.detach().chunk(4, dim=0)
+    return {
+        "act_norm": LayerNormParams(pair_attention.act_norm),
+        "pair_bias_projection": LinearParams(pair_attention.pair_bias_projection),
+        "q_projection": {"weights": LinearWeightMHA(q_weight, already_transpose_weights=True)},
+        "k_projection": {"weights": LinearWeightMHA(k_weight, already_transpose_weights=True)},
+        "v_projection": {"weights": LinearWeightMHA(v_weight)},
+        "gating_query": {"weights": LinearWeight(g_weight, already_transpose_weights=True)},
+        "output_projection": LinearParams(pair_attention.output_projection),
+    }
 
 
 def SelfAttentionParams(self_attention, use_single_cond=False):
+    # Views into the fused qkvg_projection weight, loaded in place.
+    q_weight, k_weight, v_weight, g_weight = \
+        self_attention.qkvg_projection.weight.detach().chunk(4, dim=0)
     return {
-        "q_projection": LinearHMAParams(self_attention.q_projection, use_bias=True),
-        "k_projection": LinearHMAParams(self_attention.k_projection),
-        "v_projection": LinearHMAParams(self_attention.v_projection),
-        "gating_query": LinearParams(self_attention.gating_query),
+        "q_projection": {
+            "weights": LinearWeightMHA(q_weight),
+            "bias": LinearBiasMHA(self_attention.q_bias),
+        },
+        "k_projection": {"weights": LinearWeightMHA(k_weight)},
+        "v_projection": {"weights": LinearWeightMHA(v_weight)},
+        "gating_query": {"weights": LinearWeight(g_weight)},
         "transition2": LinearParams(self_attention.adaptive_zero_init.transition2),
         **AdaptiveLayerNormParams(self_attention.adaptive_layernorm, use_single_cond),
         **AdaLNZeroParams(self_attention.adaptive_zero_init, use_single_cond),
     }
 
 
-def CrossAttentionParams(cross_attention): return {
-    **cat_params(AdaptiveLayerNormParams(cross_attention.q_adaptive_layernorm, use_single_cond=True), "q"),
-    **cat_params(AdaptiveLayerNormParams(cross_attention.k_adaptive_layernorm, use_single_cond=True), "k"),
-    "q_projection": LinearHMAParams(cross_attention.q_projection, use_bias=True),
-    "k_projection": LinearHMAParams(cross_attention.k_projection),
-    "v_projection": LinearHMAParams(cross_attention.v_projection),
-    "gating_query": LinearParams(cross_attention.gating_query),
-    **AdaLNZeroParams(cross_attention.adaptive_zero_init, use_single_cond=True),
-}
+def CrossAttentionParams(cross_attention):
+    # Views into the fused kv_projection weight, loaded in place.
+    k_weight, v_weight = torch.split(
+        cross_attention.kv_projection.weight.detach(),
+        [cross_attention.key_dim, cross_attention.value_dim], dim=0)
+    return {
+        **cat_params(AdaptiveLayerNormParams(cross_attention.q_adaptive_layernorm, use_single_cond=True), "q"),
+        **cat_params(AdaptiveLayerNormParams(cross_attention.k_adaptive_layernorm, use_single_cond=True), "k"),
+        "q_projection": LinearHMAParams(cross_attention.q_projection, use_bias=True),
+        "k_projection": {"weights": LinearWeightMHA(k_weight)},
+        "v_projection": {"weights": LinearWeightMHA(v_weight)},
+        "gating_query": LinearParams(cross_attention.gating_query),
+        **AdaLNZeroParams(cross_attention.adaptive_zero_init, use_single_cond=True),
+    }
 
 
 def MSAAttentionParams(msa_attention): return {
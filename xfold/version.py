@@ -1,7 +1,6 @@
-import re
-
 VERSION = "0.0.1"
 
 
 def is_release_version():
-    return bool(re.match(r"^\d+\.\d+\.\d+$", VERSION))
\ No newline at end of file
+    parts = VERSION.split(".")
+    return len(parts) == 3 and all(part.isdecimal() for part in parts)
\ No newline at end of file